@@ -1,14 +1,19 @@
 import os
 import hmac
-import json
 import time
+import asyncio
 import hashlib
+import functools
+from datetime import datetime
 from typing import Any
 from contextlib import asynccontextmanager
+from urllib.parse import parse_qsl
 
+import orjson
 import asyncpg
-from fastapi import FastAPI, HTTPException, Header, Query
+from fastapi import Depends, FastAPI, HTTPException, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -18,57 +23,81 @@ API_ADMIN_TOKEN = os.getenv("API_ADMIN_TOKEN")  # token for bot/service calls (a
 
 POOL: asyncpg.Pool | None = None
 
+# Secret for WebApp initData verification is fixed per bot token — derive it once.
+_WEBAPP_SECRET_KEY: bytes | None = (
+    hmac.new(b"WebAppData", BOT_TOKEN.encode("utf-8"), hashlib.sha256).digest()
+    if BOT_TOKEN
+    else None
+)
+
+
+ALLOWED_STATUSES = {"new", "in_work", "done", "cancel"}
+
 
 class DriversPayload(BaseModel):
     drivers_on_line: int
 
 
+class DriversAdjustPayload(BaseModel):
+    delta: int
+
+
 class StatusPayload(BaseModel):
     status: str
 
 
 def _parse_qs(qs: str) -> dict[str, str]:
-    out: dict[str, str] = {}
-    for part in (qs or "").split("&"):
-        if not part or "=" not in part:
-            continue
-        k, v = part.split("=", 1)
-        out[k] = v
-    return out
+    # parse_qsl percent-decodes in one C-level pass; Telegram's data_check_string
+    # is built from the decoded values, so no second unquote pass is needed.
+    return dict(parse_qsl(qs or "", keep_blank_values=True))
 
 
-def _tg_webapp_check_init_data(init_data: str, bot_token: str) -> dict[str, Any]:
-    """Verify Telegram WebApp initData signature and expiration. Return user dict."""
-    from urllib.parse import unquote
+@functools.lru_cache(maxsize=2048)
+def _tg_webapp_check_init_data(init_data: str) -> tuple[int, str | None, int]:
+    """Verify Telegram WebApp initData signature. Return (user_id, username, auth_date).
 
+    The Mini App generates initData once and reuses it for every call, so the
+    signature check is memoized on the raw string; expiration is checked by the
+    caller so a cached entry cannot outlive the 24h window.
+    """
     data = _parse_qs(init_data)
     their_hash = data.pop("hash", None)
     if not their_hash:
         raise HTTPException(401, "No hash in initData")
 
-    data_check_string = "\n".join(f"{k}={data[k]}" for k in sorted(data.keys()))
-    secret_key = hmac.new(b"WebAppData", bot_token.encode("utf-8"), hashlib.sha256).digest()
-    calc_hash = hmac.new(secret_key, data_check_string.encode("utf-8"), hashlib.sha256).hexdigest()
+    try:
+        their_digest = bytes.fromhex(their_hash)
+    except ValueError:
+        raise HTTPException(401, "Bad initData hash")
 
-    if not hmac.compare_digest(calc_hash, their_hash):
+    # Feed "k=v" pairs into the HMAC incrementally instead of materializing
+    # the full data_check_string (one f-string per key plus join plus encode).
+    mac = hmac.new(_WEBAPP_SECRET_KEY, digestmod=hashlib.sha256)
+    for i, k in enumerate(sorted(data.keys())):
+        if i:
+            mac.update(b"\n")
+        mac.update(k.encode("utf-8"))
+        mac.update(b"=")
+        mac.update(data[k].encode("utf-8"))
+    calc_digest = mac.digest()
+
+    if not hmac.compare_digest(calc_digest, their_digest):
         raise HTTPException(401, "Bad initData hash")
 
     auth_date = int(data.get("auth_date", "0") or "0")
     if not auth_date:
         raise HTTPException(401, "No auth_date")
-    if time.time() - auth_date > 86400:
-        raise HTTPException(401, "initData expired")
 
     user_raw = data.get("user")
     if not user_raw:
         raise HTTPException(401, "No user in initData")
 
     try:
-        user = json.loads(unquote(user_raw))
+        user = orjson.loads(user_raw)
     except Exception:
         raise HTTPException(401, "Bad user json in initData")
 
-    return user
+    return int(user.get("id", 0) or 0), user.get("username"), auth_date
 
 
 def _require_admin(init_data: str | None, admin_token: str | None) -> dict[str, Any]:
@@ -78,15 +107,16 @@ def _require_admin(init_data: str | None, admin_token: str | None) -> dict[str,
     2) Optional fallback token API_ADMIN_TOKEN via query admin_token
     """
     if init_data:
-        if not BOT_TOKEN:
+        if not _WEBAPP_SECRET_KEY:
             raise HTTPException(500, "BOT_TOKEN is required for initData auth")
-        user = _tg_webapp_check_init_data(init_data, BOT_TOKEN)
-        uid = int(user.get("id", 0) or 0)
+        uid, username, auth_date = _tg_webapp_check_init_data(init_data)
+        if time.time() - auth_date > 86400:
+            raise HTTPException(401, "initData expired")
         if not TARGET_USER_ID:
             raise HTTPException(500, "TARGET_USER_ID not set")
         if uid != TARGET_USER_ID:
             raise HTTPException(403, "Not an admin")
-        return user
+        return {"id": uid, "username": username}
 
     # optional fallback (можно убрать, если хочешь только Telegram)
     if API_ADMIN_TOKEN and admin_token == API_ADMIN_TOKEN:
@@ -97,6 +127,15 @@ def _require_admin(init_data: str | None, admin_token: str | None) -> dict[str,
     raise HTTPException(401, "Unauthorized")
 
 
+async def require_admin(
+    x_tg_init_data: str | None = Header(default=None, alias="X-Tg-Init-Data"),
+    tg_init_data: str | None = Query(default=None, alias="tg_init_data"),
+    admin_token: str | None = Query(default=None, alias="admin_token"),
+) -> dict[str, Any]:
+    """Shared Depends for the admin endpoints (header/query boilerplate lives here)."""
+    return _require_admin(x_tg_init_data or tg_init_data, admin_token)
+
+
 def _require_service_token(admin_token_q: str | None, admin_token_h: str | None) -> None:
     """
     Service/bot auth:
@@ -111,77 +150,190 @@ def _require_service_token(admin_token_q: str | None, admin_token_h: str | None)
 
 
 async def _get_setting(key: str, default: Any) -> Any:
-    async with POOL.acquire() as con:
-        row = await con.fetchrow("SELECT value_json FROM settings WHERE key=$1", key)
-        if not row:
-            return default
-        v = row["value_json"]
-        return v if v is not None else default
+    row = await POOL.fetchrow("SELECT value_json FROM settings WHERE key=$1", key)
+    if not row:
+        return default
+    v = row["value_json"]
+    return v if v is not None else default
 
 
 async def _set_setting(key: str, value: Any) -> Any:
-    async with POOL.acquire() as con:
-        await con.execute(
-            """
-            INSERT INTO settings(key, value_json)
-            VALUES($1, $2::jsonb)
-            ON CONFLICT(key) DO UPDATE SET value_json=EXCLUDED.value_json
-            """,
-            key,
-            json.dumps(value, ensure_ascii=False),
-        )
+    await POOL.execute(
+        """
+        INSERT INTO settings(key, value_json)
+        VALUES($1, $2)
+        ON CONFLICT(key) DO UPDATE SET value_json=EXCLUDED.value_json
+        """,
+        key,
+        value,
+    )
     return value
 
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    global POOL
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL not set")
-    POOL = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
+# Status writes from concurrent admin clicks are funneled through one queue so
+# a burst shares a single connection acquire and commit instead of one each.
+_STATUS_UPDATE_SQL = "UPDATE requests SET status=$2 WHERE id=$1 RETURNING id, created_at, status"
+_STATUS_BATCH_MAX = 128
+_STATUS_BATCH_WINDOW = 0.005
+
+_status_queue: asyncio.Queue | None = None
+_status_batcher_task: asyncio.Task | None = None
+
+
+async def _status_batcher() -> None:
+    while True:
+        batch: list[tuple[int, str, asyncio.Future]] = [await _status_queue.get()]
+        try:
+            while len(batch) < _STATUS_BATCH_MAX:
+                batch.append(await asyncio.wait_for(_status_queue.get(), _STATUS_BATCH_WINDOW))
+        except asyncio.TimeoutError:
+            pass
+
+        # Resolve futures only after the transaction commits — a later item
+        # failing rolls back the whole batch, and no endpoint may have
+        # answered 200 for an update that never persisted.
+        results: list[tuple[asyncio.Future, asyncpg.Record | None]] = []
+        try:
+            async with POOL.acquire() as con:
+                async with con.transaction():
+                    for req_id, status, fut in batch:
+                        row = await con.fetchrow(_STATUS_UPDATE_SQL, req_id, status)
+                        results.append((fut, row))
+        except Exception as e:
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+
+        for fut, row in results:
+            if not fut.done():
+                fut.set_result(row)
+
+
+async def _update_status(req_id: int, status: str) -> asyncpg.Record | None:
+    fut = asyncio.get_running_loop().create_future()
+    _status_queue.put_nowait((req_id, status, fut))
+    return await fut
+
 
+async def _init_connection(con: asyncpg.Connection) -> None:
+    # Send/receive jsonb as Python objects directly instead of a Python-side
+    # dump + server-side text->jsonb parse on every write.
+    await con.set_type_codec(
+        "jsonb",
+        encoder=lambda v: orjson.dumps(v).decode(),
+        decoder=orjson.loads,
+        schema="pg_catalog",
+        format="text",
+    )
+
+
+# Bump when the DDL below changes; workers that see a current version skip the
+# whole block, so rolling restarts don't re-run DDL or contend on locks.
+_SCHEMA_VERSION = 2
+
+
+async def _migrate() -> None:
     async with POOL.acquire() as con:
         await con.execute("""
-        CREATE TABLE IF NOT EXISTS settings (
-          key TEXT PRIMARY KEY,
-          value_json JSONB NOT NULL
+        CREATE TABLE IF NOT EXISTS schema_version (
+          version INT NOT NULL
         );
         """)
-        await con.execute("""
-        CREATE TABLE IF NOT EXISTS requests (
-          id           BIGSERIAL PRIMARY KEY,
-          created_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
-
-          tg_user_id   BIGINT,
-          tg_username  TEXT,
-          tg_full_name TEXT,
-
-          phone            TEXT,
-          phone_formatted  TEXT,
-          car_brand        TEXT,
-          address          TEXT,
-          geo              TEXT,
-          yandex_link      TEXT,
-
-          payload_json  JSONB,
-          status        TEXT NOT NULL DEFAULT 'new'
-        );
-        """)
-        row = await con.fetchrow("SELECT 1 FROM settings WHERE key='drivers_on_line'")
-        if not row:
+        ver = await con.fetchval("SELECT version FROM schema_version LIMIT 1")
+        if ver == _SCHEMA_VERSION:
+            return
+
+        async with con.transaction():
+            await con.execute("""
+            CREATE TABLE IF NOT EXISTS settings (
+              key TEXT PRIMARY KEY,
+              value_json JSONB NOT NULL
+            );
+            """)
+            await con.execute("""
+            CREATE TABLE IF NOT EXISTS requests (
+              id           BIGSERIAL PRIMARY KEY,
+              created_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+
+              tg_user_id   BIGINT,
+              tg_username  TEXT,
+              tg_full_name TEXT,
+
+              phone            TEXT,
+              phone_formatted  TEXT,
+              car_brand        TEXT,
+              address          TEXT,
+              geo              TEXT,
+              yandex_link      TEXT,
+
+              payload_json  JSONB,
+              status        TEXT NOT NULL DEFAULT 'new'
+            );
+            """)
             await con.execute(
-                "INSERT INTO settings(key, value_json) VALUES('drivers_on_line', $1::jsonb)",
-                json.dumps(0),
+                "CREATE INDEX IF NOT EXISTS requests_created_desc ON requests (created_at DESC, id DESC);"
             )
+            row = await con.fetchrow("SELECT 1 FROM settings WHERE key='drivers_on_line'")
+            if not row:
+                await con.execute(
+                    "INSERT INTO settings(key, value_json) VALUES('drivers_on_line', $1)",
+                    0,
+                )
+            # v2: status as a 4-byte enum instead of TEXT — faster comparisons,
+            # smaller rows/indexes, and invalid values fail at insert time.
+            # asyncpg still encodes/decodes it as a plain Python str.
+            await con.execute("""
+            DO $$ BEGIN
+              CREATE TYPE req_status AS ENUM ('new', 'in_work', 'done', 'cancel');
+            EXCEPTION WHEN duplicate_object THEN NULL;
+            END $$;
+            """)
+            await con.execute("ALTER TABLE requests ALTER COLUMN status DROP DEFAULT;")
+            await con.execute(
+                "ALTER TABLE requests ALTER COLUMN status TYPE req_status USING status::req_status;"
+            )
+            await con.execute("ALTER TABLE requests ALTER COLUMN status SET DEFAULT 'new';")
+            await con.execute("DELETE FROM schema_version")
+            await con.execute("INSERT INTO schema_version(version) VALUES($1)", _SCHEMA_VERSION)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global POOL
+    if not DATABASE_URL:
+        raise RuntimeError("DATABASE_URL not set")
+    # NB: with N uvicorn workers total connections = N x max_size; front with
+    # PgBouncer in transaction mode if the Postgres connection cap is low.
+    POOL = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=2,
+        max_size=20,
+        command_timeout=10,
+        statement_cache_size=256,
+        max_inactive_connection_lifetime=300,
+        init=_init_connection,
+        # Short OLTP statements never win back the JIT warmup cost.
+        server_settings={"jit": "off", "application_name": "tow-api"},
+    )
+
+    await _migrate()
+
+    global _status_queue, _status_batcher_task
+    _status_queue = asyncio.Queue()
+    _status_batcher_task = asyncio.create_task(_status_batcher())
 
     yield
 
+    if _status_batcher_task:
+        _status_batcher_task.cancel()
+        _status_batcher_task = None
     if POOL:
         await POOL.close()
         POOL = None
 
 
-app = FastAPI(title="Tow API", lifespan=lifespan)
+app = FastAPI(title="Tow API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -207,14 +359,36 @@ async def health():
     return {"ok": True}
 
 
+# The public Mini App polls /api/drivers on a timer from every client, but the
+# value only changes on admin writes — cache the serialized response body for a
+# couple of seconds and hand the same bytes to every poller.
+_DRIVERS_CACHE_TTL = 2.0
+_DRIVERS_HEADERS = {"Cache-Control": "public, max-age=1"}
+_drivers_cache: tuple[int, bytes, float] | None = None  # (value, body, expires_at monotonic)
+
+
+def _cache_drivers(n: int) -> None:
+    global _drivers_cache
+    body = orjson.dumps({"drivers_on_line": n})
+    _drivers_cache = (n, body, time.monotonic() + _DRIVERS_CACHE_TTL)
+
+
+def _drivers_response(body: bytes) -> Response:
+    return Response(content=body, media_type="application/json", headers=_DRIVERS_HEADERS)
+
+
 @app.get("/api/drivers")
 async def get_drivers():
+    if _drivers_cache and _drivers_cache[2] > time.monotonic():
+        return _drivers_response(_drivers_cache[1])
+
     v = await _get_setting("drivers_on_line", 0)
     try:
         n = int(v)
     except Exception:
         n = 0
-    return {"drivers_on_line": n}
+    _cache_drivers(n)
+    return _drivers_response(_drivers_cache[1])
 
 
 # ==== BOT endpoint (исправление твоей ошибки) ====
@@ -230,17 +404,38 @@ async def bot_set_drivers(
     if n < 0:
         n = 0
     await _set_setting("drivers_on_line", n)
+    _cache_drivers(n)
     return {"drivers_on_line": n}
 
 
-@app.get("/api/admin/me")
-async def admin_me(
-    x_tg_init_data: str | None = Header(default=None, alias="X-Tg-Init-Data"),
-    tg_init_data: str | None = Query(default=None, alias="tg_init_data"),
+# +1/-1 clicks from the bot panel used to read-modify-write (two round trips
+# and a lost-update race between concurrent clicks); the adjustment happens in
+# one statement instead.
+_ADJUST_DRIVERS_SQL = """
+    INSERT INTO settings(key, value_json)
+    VALUES('drivers_on_line', to_jsonb(GREATEST(0, $1)))
+    ON CONFLICT(key) DO UPDATE
+    SET value_json = to_jsonb(GREATEST(0, (settings.value_json #>> '{}')::int + $1))
+    RETURNING (value_json #>> '{}')::int AS n
+"""
+
+
+@app.post("/api/bot/drivers/adjust")
+async def bot_adjust_drivers(
+    payload: DriversAdjustPayload,
     admin_token: str | None = Query(default=None, alias="admin_token"),
+    x_admin_token: str | None = Header(default=None, alias="X-Admin-Token"),
 ):
-    init_data = x_tg_init_data or tg_init_data
-    user = _require_admin(init_data, admin_token)
+    _require_service_token(admin_token, x_admin_token)
+
+    row = await POOL.fetchrow(_ADJUST_DRIVERS_SQL, int(payload.delta))
+    n = int(row["n"])
+    _cache_drivers(n)
+    return {"drivers_on_line": n}
+
+
+@app.get("/api/admin/me")
+async def admin_me(user: dict = Depends(require_admin)):
     return {"ok": True, "user": {"id": user.get("id"), "username": user.get("username")}}
 
 
@@ -266,54 +461,73 @@ async def set_drivers(
     if n < 0:
         n = 0
     await _set_setting("drivers_on_line", n)
+    _cache_drivers(n)
     return {"drivers_on_line": n}
 
 
+# Fixed statement texts so asyncpg can reuse one prepared plan per variant;
+# the (created_at, id) tuple cursor walks requests_created_desc instead of
+# sorting the whole table.
+_LIST_REQUESTS_SQL = """
+    SELECT id, created_at, status,
+           tg_user_id, tg_username, tg_full_name,
+           phone_formatted, phone, car_brand, address, geo, yandex_link
+    FROM requests
+    WHERE ($2::timestamptz IS NULL OR (created_at, id) < ($2, $3))
+    ORDER BY created_at DESC, id DESC
+    LIMIT $1
+"""
+
+# Column order must match the SELECT lists below; rows are rebuilt from value
+# tuples via zip instead of per-row Record->dict key hashing.
+_LIST_REQUESTS_COLS = (
+    "id", "created_at", "status",
+    "tg_user_id", "tg_username", "tg_full_name",
+    "phone_formatted", "phone", "car_brand", "address", "geo", "yandex_link",
+)
+
+_LIST_REQUESTS_BY_STATUS_SQL = """
+    SELECT id, created_at, status,
+           tg_user_id, tg_username, tg_full_name,
+           phone_formatted, phone, car_brand, address, geo, yandex_link
+    FROM requests
+    WHERE status = $4
+      AND ($2::timestamptz IS NULL OR (created_at, id) < ($2, $3))
+    ORDER BY created_at DESC, id DESC
+    LIMIT $1
+"""
+
+
 @app.get("/api/admin/requests")
 async def admin_list_requests(
     limit: int = Query(20, ge=1, le=100),
     status: str | None = Query(None),
-    x_tg_init_data: str | None = Header(default=None, alias="X-Tg-Init-Data"),
-    tg_init_data: str | None = Query(default=None, alias="tg_init_data"),
-    admin_token: str | None = Query(default=None, alias="admin_token"),
+    cursor_ts: datetime | None = Query(None),
+    cursor_id: int | None = Query(None),
+    user: dict = Depends(require_admin),
 ):
-    init_data = x_tg_init_data or tg_init_data
-    _require_admin(init_data, admin_token)
+    # Keyset cursor: pass created_at/id of the last row of the previous page.
+    if cursor_ts is None or cursor_id is None:
+        cursor_ts = None
+        cursor_id = None
 
-    where = ""
-    args: list[Any] = [limit]
     if status:
-        where = "WHERE status = $2"
-        args.append(status)
-
-    async with POOL.acquire() as con:
-        rows = await con.fetch(
-            f"""
-            SELECT id, created_at, status,
-                   tg_user_id, tg_username, tg_full_name,
-                   phone_formatted, phone, car_brand, address, geo, yandex_link
-            FROM requests
-            {where}
-            ORDER BY created_at DESC
-            LIMIT $1
-            """,
-            *args
-        )
-    return {"items": [dict(r) for r in rows]}
+        # $4 binds as req_status since the enum migration, so an unknown value
+        # would blow up in Postgres — reject it here instead.
+        if status not in ALLOWED_STATUSES:
+            raise HTTPException(400, "Bad status")
+        rows = await POOL.fetch(_LIST_REQUESTS_BY_STATUS_SQL, limit, cursor_ts, cursor_id, status)
+    else:
+        rows = await POOL.fetch(_LIST_REQUESTS_SQL, limit, cursor_ts, cursor_id)
+    return ORJSONResponse({"items": [dict(zip(_LIST_REQUESTS_COLS, r)) for r in rows]})
 
 
 @app.get("/api/admin/requests/{req_id}")
 async def admin_get_request(
     req_id: int,
-    x_tg_init_data: str | None = Header(default=None, alias="X-Tg-Init-Data"),
-    tg_init_data: str | None = Query(default=None, alias="tg_init_data"),
-    admin_token: str | None = Query(default=None, alias="admin_token"),
+    user: dict = Depends(require_admin),
 ):
-    init_data = x_tg_init_data or tg_init_data
-    _require_admin(init_data, admin_token)
-
-    async with POOL.acquire() as con:
-        row = await con.fetchrow("SELECT * FROM requests WHERE id=$1", req_id)
+    row = await POOL.fetchrow("SELECT * FROM requests WHERE id=$1", req_id)
     if not row:
         raise HTTPException(404, "Not found")
     return {"item": dict(row)}
@@ -323,22 +537,15 @@ async def admin_get_request(
 async def admin_set_request_status(
     req_id: int,
     payload: StatusPayload,
-    x_tg_init_data: str | None = Header(default=None, alias="X-Tg-Init-Data"),
-    tg_init_data: str | None = Query(default=None, alias="tg_init_data"),
-    admin_token: str | None = Query(default=None, alias="admin_token"),
+    user: dict = Depends(require_admin),
 ):
-    init_data = x_tg_init_data or tg_init_data
-    _require_admin(init_data, admin_token)
-
     status = (payload.status or "").strip()
-    if status not in {"new", "in_work", "done", "cancel"}:
+    if status not in ALLOWED_STATUSES:
         raise HTTPException(400, "Bad status")
 
-    async with POOL.acquire() as con:
-        res = await con.execute("UPDATE requests SET status=$2 WHERE id=$1", req_id, status)
-        if res.split()[-1] == "0":
-            raise HTTPException(404, "Not found")
-        row = await con.fetchrow("SELECT id, created_at, status FROM requests WHERE id=$1", req_id)
+    row = await _update_status(req_id, status)
+    if row is None:
+        raise HTTPException(404, "Not found")
 
     return {"item": dict(row)}
 
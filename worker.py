@@ -1,16 +1,22 @@
 import os
-import json
 import time
 import re
+import secrets
 import asyncio
+import functools
 from datetime import datetime, timezone
-from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+from typing import Any
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse, quote
 
+import orjson
 import asyncpg
 import aiohttp
+from aiohttp import web
+from cachetools import LRUCache, TTLCache
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import Command, CommandObject, CommandStart
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.filters import Command, CommandObject, CommandStart, Filter
 from aiogram.types import (
     Message, ReplyKeyboardMarkup, KeyboardButton, WebAppInfo,
     InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
@@ -22,14 +28,34 @@ TARGET_USER_ID = int(os.getenv("TARGET_USER_ID", "0"))
 WEBAPP_URL = os.getenv("WEBAPP_URL")          # GitHub Pages
 API_BASE_URL = os.getenv("API_BASE_URL")      # https://<api-service>.onrender.com
 API_ADMIN_TOKEN = os.getenv("API_ADMIN_TOKEN")
+
+# Endpoint URLs and the auth header never change at runtime — build them once.
+_API_ROOT = (API_BASE_URL or "").rstrip("/")
+API_DRIVERS_URL = _API_ROOT + "/api/drivers"
+API_BOT_DRIVERS_URL = _API_ROOT + "/api/bot/drivers"
+ADMIN_HEADERS = {"X-Admin-Token": API_ADMIN_TOKEN or ""}
 DATABASE_URL = os.getenv("DATABASE_URL")
+# When set, Telegram pushes updates to <WEBHOOK_BASE_URL>/tg/webhook instead of
+# the bot long-polling getUpdates; unset keeps the polling fallback.
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")
+WEBHOOK_PATH = "/tg/webhook"
+# Telegram echoes this back in X-Telegram-Bot-Api-Secret-Token on every push;
+# without it anyone who finds the webhook URL can POST forged updates (e.g.
+# with from_user.id = TARGET_USER_ID). Set the env var to keep the secret
+# stable across replicas; a fresh random one per process works for a single
+# instance since set_webhook registers it at startup.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
 
 dp = Dispatcher()
 
-greeted_users: set[int] = set()
-last_request_ts: dict[int, float] = {}
 COOLDOWN_SECONDS = 5 * 60
 
+# Bounded caches so user state can't grow for the process lifetime: greeted
+# users evict LRU-style, cooldown entries expire on their own (monotonic clock,
+# so wall-clock jumps can't break the cooldown math).
+greeted_users: LRUCache = LRUCache(maxsize=50_000)  # uid -> True, used as a set
+last_request_ts: TTLCache = TTLCache(maxsize=10_000, ttl=COOLDOWN_SECONDS, timer=time.monotonic)
+
 DB_POOL: asyncpg.Pool | None = None
 HTTP: aiohttp.ClientSession | None = None
 
@@ -64,23 +90,40 @@ def is_dispatcher(message: Message) -> bool:
     return bool(message.from_user) and is_dispatcher_user_id(message.from_user.id)
 
 
-def with_query(url: str, **params) -> str:
-    p = urlparse(url)
+@functools.lru_cache(maxsize=1)
+def _webapp_url_parts() -> tuple[str, str]:
+    """Parse WEBAPP_URL once: (prefix ending in ?/&, pre-quoted api URL)."""
+    p = urlparse(WEBAPP_URL)
     q = dict(parse_qsl(p.query, keep_blank_values=True))
-    for k, v in params.items():
-        if v is None:
-            q.pop(k, None)
-        else:
-            q[k] = str(v)
-    return urlunparse((p.scheme, p.netloc, p.path, p.params, urlencode(q, doseq=True), p.fragment))
+    q.pop("drivers", None)
+    q.pop("api", None)
+    base = urlunparse((p.scheme, p.netloc, p.path, p.params, urlencode(q, doseq=True), ""))
+    prefix = base + ("&" if q else "?")
+    api_quoted = quote(API_DRIVERS_URL, safe="")
+    return prefix, api_quoted
+
+
+def _webapp_url_for(drivers: int) -> str:
+    prefix, api_quoted = _webapp_url_parts()
+    return f"{prefix}drivers={drivers}&api={api_quoted}"
+
+
+# Resolve the local timezone once; per-call .astimezone() re-does the lookup.
+_LOCAL_TZ = datetime.now(timezone.utc).astimezone().tzinfo
+
+
+def _fmt_dt(dt: datetime, seconds: bool = True) -> str:
+    # Attribute access + f-string is noticeably cheaper than strftime's
+    # locale-aware C path when formatting a whole /requests listing.
+    s = f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d} {dt.hour:02d}:{dt.minute:02d}"
+    return f"{s}:{dt.second:02d}" if seconds else s
 
 
 def _dt(ts_ms: int | None) -> str:
     if not ts_ms:
         return "—"
     try:
-        dt = datetime.fromtimestamp(ts_ms / 1000, tz=timezone.utc).astimezone()
-        return dt.strftime("%Y-%m-%d %H:%M:%S")
+        return _fmt_dt(datetime.fromtimestamp(ts_ms / 1000, tz=_LOCAL_TZ))
     except Exception:
         return "—"
 
@@ -90,34 +133,54 @@ def _clean(s: str | None) -> str:
     return s if s else "—"
 
 
+_GEO_RE = re.compile(r"\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$")
+_DIGITS_RE = re.compile(r"\d{1,6}")
+
+
 def _yandex_maps_link_from_geo(geo_text: str | None) -> str | None:
-    if not geo_text:
-        return None
-    t = geo_text.replace(" ", "")
-    if "," not in t:
+    m = _GEO_RE.match(geo_text or "")
+    if not m:
         return None
-    lat_s, lon_s = t.split(",", 1)
-    try:
-        lat = float(lat_s)
-        lon = float(lon_s)
-    except Exception:
-        return None
-    return f"https://yandex.ru/maps/?pt={lon},{lat}&z=16&l=map"
+    return f"https://yandex.ru/maps/?pt={m.group(2)},{m.group(1)}&z=16&l=map"
 
 
-def _user_tag_from_row(r: dict) -> str:
-    if r.get("tg_username"):
+def _user_tag_from_row(r: asyncpg.Record) -> str:
+    if r["tg_username"]:
         return f"@{r['tg_username']}"
-    return r.get("tg_full_name") or "—"
+    return r["tg_full_name"] or "—"
 
 
 # ---------------- DB (requests/statuses) ----------------
 
+async def _db_init_connection(con: asyncpg.Connection) -> None:
+    # Same jsonb codec as the API pool: payload dicts go to asyncpg as-is and
+    # rows come back decoded, without a json.dumps/loads hop per call.
+    await con.set_type_codec(
+        "jsonb",
+        encoder=lambda v: orjson.dumps(v).decode(),
+        decoder=orjson.loads,
+        schema="pg_catalog",
+        format="text",
+    )
+
+
 async def db_init():
     global DB_POOL
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL не задан")
-    DB_POOL = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
+    DB_POOL = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=int(os.getenv("PG_POOL_MIN", "5")),
+        max_size=int(os.getenv("PG_POOL_MAX", "20")),
+        max_inactive_connection_lifetime=300,
+        command_timeout=10,
+        statement_cache_size=256,
+        init=_db_init_connection,
+        # Short OLTP statements never win back the JIT warmup cost.
+        server_settings={"jit": "off", "application_name": "tow-bot"},
+    )
+    # Touch the pool so min_size connections open now, not on the first burst.
+    await DB_POOL.execute("SELECT 1")
 
     async with DB_POOL.acquire() as con:
         await con.execute("""
@@ -141,7 +204,21 @@ async def db_init():
         );
         """)
         await con.execute("CREATE INDEX IF NOT EXISTS requests_created_at_idx ON requests (created_at DESC);")
-        await con.execute("CREATE INDEX IF NOT EXISTS requests_status_idx ON requests (status);")
+        # Composite (status, recency) serves the API's status-filtered keyset
+        # listing without a sort and covers everything the old single-column
+        # status index did, so the latter is dropped.
+        await con.execute(
+            "CREATE INDEX IF NOT EXISTS requests_status_created_idx"
+            " ON requests (status, created_at DESC, id DESC);"
+        )
+        await con.execute("DROP INDEX IF EXISTS requests_status_idx;")
+        await con.execute("""
+        CREATE TABLE IF NOT EXISTS user_state (
+          tg_user_id      BIGINT PRIMARY KEY,
+          greeted_at      TIMESTAMPTZ,
+          last_request_at TIMESTAMPTZ
+        );
+        """)
 
 
 async def db_close():
@@ -151,18 +228,23 @@ async def db_close():
         DB_POOL = None
 
 
-async def db_create_request(*, u, payload: dict) -> int:
-    yandex_link = _yandex_maps_link_from_geo(payload.get("geo"))
-    async with DB_POOL.acquire() as con:
-        row = await con.fetchrow("""
-            INSERT INTO requests(
-              tg_user_id, tg_username, tg_full_name,
-              phone, phone_formatted, car_brand, address, geo, yandex_link,
-              payload_json
-            )
-            VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9,$10)
-            RETURNING id
-        """,
+_INSERT_REQUEST_SQL = """
+    INSERT INTO requests(
+      tg_user_id, tg_username, tg_full_name,
+      phone, phone_formatted, car_brand, address, geo, yandex_link,
+      payload_json
+    )
+    VALUES($1,$2,$3,$4,$5,$6,$7,$8,$9,$10)
+    RETURNING id
+"""
+
+
+def _request_insert_args(u, payload: dict, yandex_link: str | None = None) -> tuple:
+    # Callers that already derived the link pass it in so the geo regex runs
+    # once per submission, not once per consumer.
+    if yandex_link is None:
+        yandex_link = _yandex_maps_link_from_geo(payload.get("geo"))
+    return (
         u.id,
         u.username,
         u.full_name,
@@ -172,47 +254,131 @@ async def db_create_request(*, u, payload: dict) -> int:
         payload.get("address"),
         payload.get("geo"),
         yandex_link,
-        json.dumps(payload, ensure_ascii=False)
-        )
-        return int(row["id"])
+        payload,
+    )
 
 
-async def db_get_request(req_id: int) -> dict | None:
-    async with DB_POOL.acquire() as con:
-        row = await con.fetchrow("SELECT * FROM requests WHERE id=$1", req_id)
-        return dict(row) if row else None
+async def db_create_request(*, u, payload: dict) -> int:
+    return int(await DB_POOL.fetchval(_INSERT_REQUEST_SQL, *_request_insert_args(u, payload)))
+
+
+async def db_get_request(req_id: int) -> asyncpg.Record | None:
+    # Everything the details view renders — notably excludes payload_json,
+    # which can be kilobytes the formatter never looks at.
+    return await DB_POOL.fetchrow(
+        """
+        SELECT
+          id, created_at, status,
+          tg_username, tg_full_name,
+          phone, phone_formatted, car_brand, address, geo, yandex_link
+        FROM requests
+        WHERE id=$1
+        """,
+        req_id,
+    )
 
 
-async def db_list_requests(limit: int = 10) -> list[dict]:
+async def db_list_requests(limit: int = 10, before_id: int | None = None) -> list[asyncpg.Record]:
+    # Keyset pagination on the primary key: "older than #id" walks the PK index
+    # instead of OFFSET re-scanning everything already shown.
     limit = max(1, min(50, int(limit)))
-    async with DB_POOL.acquire() as con:
-        rows = await con.fetch(
-            """
-            SELECT
-              id, created_at, status,
-              tg_username, tg_full_name,
-              phone_formatted, car_brand, address,
-              yandex_link, geo
-            FROM requests
-            ORDER BY created_at DESC
-            LIMIT $1
-            """,
-            limit
-        )
-        return [dict(r) for r in rows]
+    # The per-row COALESCE/user-tag fallbacks run in the projection, so the
+    # listing builder gets display-ready columns instead of re-deriving them
+    # per row in Python.
+    rows = await DB_POOL.fetch(
+        """
+        SELECT
+          id, created_at, status,
+          COALESCE('@' || tg_username, NULLIF(tg_full_name, ''), '—') AS user_tag,
+          COALESCE(NULLIF(phone_formatted, ''), '—') AS phone,
+          COALESCE(NULLIF(car_brand, ''), '—')       AS car_brand,
+          COALESCE(NULLIF(address, ''), '—')         AS address,
+          yandex_link, geo
+        FROM requests
+        WHERE ($2::bigint IS NULL OR id < $2)
+        ORDER BY id DESC
+        LIMIT $1
+        """,
+        limit,
+        before_id,
+    )
+    return list(rows)
+
+
+async def db_try_claim_cooldown(uid: int) -> bool:
+    """Atomically claim the cooldown slot: stamps last_request_at and returns
+    True iff the previous stamp was absent or older than the cooldown. One
+    round trip, no check-then-set race between replicas."""
+    row = await DB_POOL.fetchrow(
+        """
+        INSERT INTO user_state(tg_user_id, last_request_at)
+        VALUES($1, now())
+        ON CONFLICT (tg_user_id) DO UPDATE SET last_request_at = now()
+          WHERE user_state.last_request_at IS NULL
+             OR user_state.last_request_at <= now() - make_interval(secs => $2)
+        RETURNING 1
+        """,
+        uid,
+        COOLDOWN_SECONDS,
+    )
+    return row is not None
+
+
+async def db_cooldown_remaining(uid: int) -> int:
+    """Remaining cooldown seconds according to the shared store (0 = clear)."""
+    row = await DB_POOL.fetchrow(
+        """
+        SELECT GREATEST(0, $2 - EXTRACT(EPOCH FROM (now() - last_request_at)))::int AS remain
+        FROM user_state
+        WHERE tg_user_id=$1 AND last_request_at IS NOT NULL
+        """,
+        uid,
+        COOLDOWN_SECONDS,
+    )
+    return int(row["remain"]) if row else 0
+
+
+async def db_mark_greeted(uid: int) -> bool:
+    """Record the greeting; True only the first time this user is seen."""
+    row = await DB_POOL.fetchrow(
+        """
+        INSERT INTO user_state(tg_user_id, greeted_at)
+        VALUES($1, now())
+        ON CONFLICT (tg_user_id) DO UPDATE SET greeted_at = now()
+          WHERE user_state.greeted_at IS NULL
+        RETURNING 1
+        """,
+        uid,
+    )
+    return row is not None
 
 
 async def db_set_status(req_id: int, status: str) -> bool:
-    async with DB_POOL.acquire() as con:
-        res = await con.execute("UPDATE requests SET status=$2 WHERE id=$1", req_id, status)
-        return res.split()[-1] != "0"
+    res = await DB_POOL.execute("UPDATE requests SET status=$2 WHERE id=$1", req_id, status)
+    return res.split()[-1] != "0"
 
 
 # ---------------- HTTP (to API service) ----------------
 
+# Shared timeout objects: the session-wide ceiling covers anything unusual,
+# while the short drivers calls carry their own 5s bound so a slow API can't
+# hold a panel render for the full session timeout.
+_HTTP_TIMEOUT_SESSION = aiohttp.ClientTimeout(total=30, sock_connect=5)
+_HTTP_TIMEOUT_DRIVERS = aiohttp.ClientTimeout(total=5)
+
+
 async def http_init():
     global HTTP
-    HTTP = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15))
+    # Keep-alive + DNS caching: the bot talks to a single API host, so reusing
+    # warm connections avoids a TLS handshake on every drivers call.
+    connector = aiohttp.TCPConnector(
+        limit=32,
+        limit_per_host=32,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+        enable_cleanup_closed=True,
+    )
+    HTTP = aiohttp.ClientSession(connector=connector, timeout=_HTTP_TIMEOUT_SESSION)
 
 
 async def http_close():
@@ -222,122 +388,211 @@ async def http_close():
         HTTP = None
 
 
-async def api_get_drivers() -> int:
-    url = API_BASE_URL.rstrip("/") + "/api/drivers"
-    async with HTTP.get(url) as r:
-        j = await r.json()
-        return int(j.get("drivers_on_line", 0))
+# Bursts of /start and panel refreshes share one upstream fetch within the TTL;
+# on API errors we keep serving the last known value instead of dropping to 0.
+DRIVERS_CACHE_TTL = float(os.getenv("DRIVERS_CACHE_TTL", "5"))
 
+_drivers_cache = {"val": 0, "exp": 0.0}
+_drivers_cache_lock = asyncio.Lock()
+
+
+def _cache_drivers(val: int) -> None:
+    _drivers_cache["val"] = val
+    _drivers_cache["exp"] = time.monotonic() + DRIVERS_CACHE_TTL
+
+
+# Circuit breaker: after 3 consecutive transport errors the API is considered
+# down for 30s — reads serve the cached value instantly and writes fail fast
+# instead of every caller waiting out the full HTTP timeout.
+_CB_FAIL_THRESHOLD = 3
+_CB_OPEN_SECONDS = 30.0
+_cb = {"fail": 0, "open_until": 0.0}
 
-async def api_set_drivers(n: int) -> int:
-    # ВАЖНО: бот ходит в bot-endpoint, авторизация через X-Admin-Token
-    url = API_BASE_URL.rstrip("/") + "/api/bot/drivers"
-    headers = {"X-Admin-Token": API_ADMIN_TOKEN or ""}
 
-    async with HTTP.post(url, json={"drivers_on_line": int(n)}, headers=headers) as r:
-        text = await r.text()
+def _cb_is_open() -> bool:
+    return time.monotonic() < _cb["open_until"]
+
+
+def _cb_success() -> None:
+    _cb["fail"] = 0
+
+
+def _cb_failure() -> None:
+    _cb["fail"] += 1
+    if _cb["fail"] >= _CB_FAIL_THRESHOLD:
+        _cb["fail"] = 0
+        _cb["open_until"] = time.monotonic() + _CB_OPEN_SECONDS
+
+
+async def api_get_drivers() -> int:
+    if time.monotonic() < _drivers_cache["exp"]:
+        return _drivers_cache["val"]
+
+    async with _drivers_cache_lock:
+        if time.monotonic() < _drivers_cache["exp"] or _cb_is_open():
+            return _drivers_cache["val"]
         try:
-            j = json.loads(text)
+            async with HTTP.get(API_DRIVERS_URL, timeout=_HTTP_TIMEOUT_DRIVERS) as r:
+                j = await r.json()
+                val = int(j.get("drivers_on_line", 0))
         except Exception:
-            j = {"raw": text}
+            # Stale fallback: re-arm the TTL so an outage doesn't hammer the API.
+            _cb_failure()
+            _cache_drivers(_drivers_cache["val"])
+            return _drivers_cache["val"]
+        _cb_success()
+        _cache_drivers(val)
+        return val
+
+
+async def _drivers_post(url: str, payload: dict) -> int:
+    if _cb_is_open():
+        raise RuntimeError("drivers API недоступен (circuit breaker открыт)")
+    try:
+        async with HTTP.post(url, json=payload, headers=ADMIN_HEADERS, timeout=_HTTP_TIMEOUT_DRIVERS) as r:
+            status = r.status
+            body = await r.read()
+    except Exception:
+        _cb_failure()
+        raise
+    _cb_success()
+
+    try:
+        j = orjson.loads(body)
+    except Exception:
+        j = {"raw": body.decode(errors="replace")}
+
+    # Non-2xx means the API answered: the transport is healthy, so it does
+    # not count against the breaker.
+    if status != 200:
+        raise RuntimeError(f"API error {status}: {j}")
+
+    val = int(j.get("drivers_on_line", 0))
+    _cache_drivers(val)
+    return val
+
+
+async def api_set_drivers(n: int) -> int:
+    # ВАЖНО: бот ходит в bot-endpoint, авторизация через X-Admin-Token
+    return await _drivers_post(API_BOT_DRIVERS_URL, {"drivers_on_line": int(n)})
 
-        if r.status != 200:
-            raise RuntimeError(f"API error {r.status}: {j}")
 
-        return int(j.get("drivers_on_line", 0))
+async def api_adjust_drivers(delta: int) -> int:
+    # Атомарный +N/-N на стороне API: один запрос вместо get + set и без
+    # гонки между одновременными кликами.
+    return await _drivers_post(API_BOT_DRIVERS_URL + "/adjust", {"delta": int(delta)})
 
 
 # ---------------- UI helpers ----------------
 
+@functools.lru_cache(maxsize=8)
+def _start_kb(drivers: int) -> ReplyKeyboardMarkup:
+    # The keyboard only varies with the drivers count baked into the WebApp
+    # URL, so cache the built pydantic models instead of re-validating per /start.
+    webapp_url = _webapp_url_for(drivers)
+    return ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text="Заказать эвакуатор", web_app=WebAppInfo(url=webapp_url))]],
+        resize_keyboard=True,
+    )
+
+# The drivers-less variant is fully static; build it once.
+_PANEL_TEXT_NO_DRIVERS = "Панель менеджера\n\nВыберите действие кнопками ниже."
+
+
 def build_manager_panel_text(drivers: int | None = None) -> str:
-    lines = ["Панель менеджера"]
-    if drivers is not None:
-        lines.append(f"Водителей на линии: {drivers}")
-    lines.append("")
-    lines.append("Выберите действие кнопками ниже.")
-    return "\n".join(lines)
+    if drivers is None:
+        return _PANEL_TEXT_NO_DRIVERS
+    return f"Панель менеджера\nВодителей на линии: {drivers}\n\nВыберите действие кнопками ниже."
+
+
+# The panel and drivers keyboards are fully static — validate the pydantic
+# models once at import and hand the same instances to every callback.
+_MANAGER_PANEL_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="Заявки (последние 10)", callback_data="panel:req:10"),
+        ],
+        [
+            InlineKeyboardButton(text="Заявки (последние 20)", callback_data="panel:req:20"),
+        ],
+        [
+            InlineKeyboardButton(text="Заявки (последние 50)", callback_data="panel:req:50"),
+        ],
+        [
+            InlineKeyboardButton(text="Водители на линии", callback_data="panel:drivers"),
+        ],
+    ]
+)
+
+_DRIVERS_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="Обновить", callback_data="panel:drivers"),
+            InlineKeyboardButton(text="+1", callback_data="panel:drivers_add:1"),
+            InlineKeyboardButton(text="-1", callback_data="panel:drivers_add:-1"),
+        ],
+        [
+            InlineKeyboardButton(text="Установить число…", callback_data="panel:drivers_set"),
+        ],
+        [
+            InlineKeyboardButton(text="Назад", callback_data="panel:home"),
+        ],
+    ]
+)
+
+_PANEL_HOME_BTN = InlineKeyboardButton(text="Панель", callback_data="panel:home")
 
 
 def build_manager_panel_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="Заявки (последние 10)", callback_data="panel:req:10"),
-            ],
-            [
-                InlineKeyboardButton(text="Заявки (последние 20)", callback_data="panel:req:20"),
-            ],
-            [
-                InlineKeyboardButton(text="Заявки (последние 50)", callback_data="panel:req:50"),
-            ],
-            [
-                InlineKeyboardButton(text="Водители на линии", callback_data="panel:drivers"),
-            ],
-        ]
-    )
+    return _MANAGER_PANEL_KB
 
 
 def build_drivers_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="Обновить", callback_data="panel:drivers"),
-                InlineKeyboardButton(text="+1", callback_data="panel:drivers_add:1"),
-                InlineKeyboardButton(text="-1", callback_data="panel:drivers_add:-1"),
-            ],
-            [
-                InlineKeyboardButton(text="Установить число…", callback_data="panel:drivers_set"),
-            ],
-            [
-                InlineKeyboardButton(text="Назад", callback_data="panel:home"),
-            ],
-        ]
-    )
+    return _DRIVERS_KB
 
 
-def build_requests_list_text(items: list[dict]) -> str:
+def build_requests_list_text(items: list[asyncpg.Record]) -> str:
     blocks: list[str] = []
     for r in items:
-        created = r["created_at"].strftime("%Y-%m-%d %H:%M")
-        user_tag = _user_tag_from_row(r)
-        maps = r.get("yandex_link") or _yandex_maps_link_from_geo(r.get("geo"))
-
-        block_lines = [
-            f"#{r['id']} | {created} | {r.get('status')}",
-            f"Пользователь: {user_tag}",
-            f"Телефон: {r.get('phone_formatted') or '—'}",
-            f"Марка: {r.get('car_brand') or '—'}",
-            f"Адрес: {r.get('address') or '—'}",
-        ]
+        rid = r["id"]
+        created = _fmt_dt(r["created_at"], seconds=False)
+        maps = r["yandex_link"] or _yandex_maps_link_from_geo(r["geo"])
+
+        # One f-string per block instead of a per-line list + join.
+        block = (
+            f"#{rid} | {created} | {r['status']}\n"
+            f"Пользователь: {r['user_tag']}\n"
+            f"Телефон: {r['phone']}\n"
+            f"Марка: {r['car_brand']}\n"
+            f"Адрес: {r['address']}"
+        )
         if maps:
-            block_lines.append(f"Яндекс.Карты: {maps}")
-
-        block_lines.append(f"Подробно: /request {r['id']}")
-        blocks.append("\n".join(block_lines))
+            block += f"\nЯндекс.Карты: {maps}"
+        blocks.append(block + f"\nПодробно: /request {rid}")
 
     return "Последние заявки:\n\n" + ("\n\n".join(blocks) if blocks else "Заявок пока нет.")
 
 
-def build_requests_list_kb(items: list[dict], limit: int) -> InlineKeyboardMarkup:
-    rows = [[InlineKeyboardButton(text="Панель", callback_data="panel:home")]]
+def build_requests_list_kb(items: list[asyncpg.Record], limit: int) -> InlineKeyboardMarkup:
+    rows = [[_PANEL_HOME_BTN]]
     for r in items:
         rows.append([InlineKeyboardButton(text=f"Подробнее #{r['id']}", callback_data=f"req:{r['id']}:{limit}")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
-def format_request_details(r: dict) -> str:
+def format_request_details(r: asyncpg.Record) -> str:
     user_tag = _user_tag_from_row(r)
-    maps = r.get("yandex_link") or _yandex_maps_link_from_geo(r.get("geo"))
+    maps = r["yandex_link"] or _yandex_maps_link_from_geo(r["geo"])
 
     lines = [
         f"Заявка #{r['id']}",
-        f"Статус: {r.get('status')}",
-        f"Создана: {r['created_at'].strftime('%Y-%m-%d %H:%M:%S')}",
+        f"Статус: {r['status']}",
+        f"Создана: {_fmt_dt(r['created_at'])}",
         f"Пользователь: {user_tag}",
-        f"Телефон: {r.get('phone_formatted') or r.get('phone') or '—'}",
-        f"Марка: {r.get('car_brand') or '—'}",
-        f"Адрес: {r.get('address') or '—'}",
-        f"Гео: {r.get('geo') or '—'}",
+        f"Телефон: {r['phone_formatted'] or r['phone'] or '—'}",
+        f"Марка: {r['car_brand'] or '—'}",
+        f"Адрес: {r['address'] or '—'}",
+        f"Гео: {r['geo'] or '—'}",
     ]
     if maps:
         lines.append(f"Яндекс.Карты: {maps}")
@@ -347,7 +602,10 @@ def format_request_details(r: dict) -> str:
     return "\n".join(lines)
 
 
+@functools.lru_cache(maxsize=256)
 def build_request_details_kb(req_id: int, limit: int) -> InlineKeyboardMarkup:
+    # Varies only with (req_id, limit); revisiting a request reuses the built
+    # markup the same way _start_kb does.
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [
@@ -389,32 +647,39 @@ async def start(message: Message) -> None:
         await message.answer("Сервис временно недоступен (не заданы WEBAPP_URL/API_BASE_URL).")
         return
 
+    # The drivers fetch is independent of the greeting — kick it off first so
+    # the API round trip overlaps the greeting send instead of following it.
+    drivers_task = asyncio.create_task(api_get_drivers())
+
+    # Local LRU is just a fast path; the DB survives restarts so returning
+    # users don't get the ~700-byte greeting again after every deploy.
     uid = message.from_user.id
     if uid not in greeted_users:
-        greeted_users.add(uid)
-        await message.answer(START_TEXT)
+        greeted_users[uid] = True
+        try:
+            first_time = await db_mark_greeted(uid)
+        except Exception:
+            first_time = True
+        if first_time:
+            await message.answer(START_TEXT)
 
     try:
-        drivers = await api_get_drivers()
+        drivers = await drivers_task
     except Exception:
         drivers = 0
 
-    api_url = API_BASE_URL.rstrip("/") + "/api/drivers"
-    webapp_url = with_query(WEBAPP_URL, drivers=drivers, api=api_url)
-
-    kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Заказать эвакуатор", web_app=WebAppInfo(url=webapp_url))]],
-        resize_keyboard=True,
-    )
-    await message.answer("Откройте мини‑апп и отправьте заявку.", reply_markup=kb)
+    await message.answer("Откройте мини‑апп и отправьте заявку.", reply_markup=_start_kb(drivers))
 
 
 # ---------------- Manager commands ----------------
+#
+# Dispatcher-only message handlers filter on from_user.id at registration, so
+# non-manager traffic is rejected inside aiogram's filter chain and never
+# enters the handler body. Callback handlers keep the in-body check because
+# they must still cb.answer() an alert for foreign clicks.
 
-@dp.message(Command("panel"))
+@dp.message(Command("panel"), F.from_user.id == TARGET_USER_ID)
 async def panel_cmd(message: Message) -> None:
-    if not is_dispatcher(message):
-        return
     try:
         drivers = await api_get_drivers()
     except Exception:
@@ -422,28 +687,31 @@ async def panel_cmd(message: Message) -> None:
     await message.answer(build_manager_panel_text(drivers), reply_markup=build_manager_panel_kb())
 
 
-@dp.message(Command("requests"))
+@dp.message(Command("requests"), F.from_user.id == TARGET_USER_ID)
 async def requests_cmd(message: Message, command: CommandObject) -> None:
-    if not is_dispatcher(message):
-        return
 
-    arg = (command.args or "").strip()
+    # /requests [n] [before_id] — before_id shows the next page of older rows.
+    args = (command.args or "").split()
     limit = 10
-    if arg:
+    before_id = None
+    if args:
         try:
-            limit = int(arg)
+            limit = int(args[0])
         except Exception:
             limit = 10
+    if len(args) > 1:
+        try:
+            before_id = int(args[1])
+        except Exception:
+            before_id = None
     limit = max(1, min(50, limit))
 
-    items = await db_list_requests(limit)
+    items = await db_list_requests(limit, before_id)
     await message.answer(build_requests_list_text(items), reply_markup=build_requests_list_kb(items, limit))
 
 
-@dp.message(Command("request"))
+@dp.message(Command("request"), F.from_user.id == TARGET_USER_ID)
 async def request_cmd(message: Message, command: CommandObject) -> None:
-    if not is_dispatcher(message):
-        return
     arg = (command.args or "").strip()
     if not arg:
         await message.answer("Использование: /request <id>")
@@ -462,10 +730,8 @@ async def request_cmd(message: Message, command: CommandObject) -> None:
     await message.answer(format_request_details(r))
 
 
-@dp.message(Command("setstatus"))
+@dp.message(Command("setstatus"), F.from_user.id == TARGET_USER_ID)
 async def setstatus_cmd(message: Message, command: CommandObject) -> None:
-    if not is_dispatcher(message):
-        return
     args = (command.args or "").strip().split()
     if len(args) != 2:
         await message.answer("Использование: /setstatus <id> <new|in_work|done|cancel>")
@@ -548,8 +814,7 @@ async def cb_panel_drivers_add(cb: CallbackQuery) -> None:
         return
 
     try:
-        cur = await api_get_drivers()
-        new_n = await api_set_drivers(max(0, cur + delta))
+        new_n = await api_adjust_drivers(delta)
         text = f"Водителей на линии: {new_n}"
         await cb.answer("Готово")
     except Exception:
@@ -570,17 +835,18 @@ async def cb_panel_drivers_set(cb: CallbackQuery) -> None:
     await cb.message.answer("Отправьте число водителей одним сообщением (например: 7).")
 
 
-@dp.message(F.text)
-async def manager_number_input(message: Message) -> None:
-    if not is_dispatcher(message):
-        return
+class AwaitingDrivers(Filter):
+    """Matches only while the manager has a pending set-drivers prompt, so
+    ordinary text traffic never enters the handler."""
+
+    async def __call__(self, message: Message) -> bool:
+        return MANAGER_AWAIT.get(message.from_user.id) == "setdrivers"
 
-    mode = MANAGER_AWAIT.get(message.from_user.id)
-    if mode != "setdrivers":
-        return
 
+@dp.message(F.text, F.from_user.id == TARGET_USER_ID, AwaitingDrivers())
+async def manager_number_input(message: Message) -> None:
     txt = (message.text or "").strip()
-    if not re.fullmatch(r"\d{1,6}", txt):
+    if not _DIGITS_RE.fullmatch(txt):
         await message.answer("Нужно отправить целое число (например: 5).")
         return
 
@@ -596,62 +862,247 @@ async def manager_number_input(message: Message) -> None:
 
 # ---------------- WebApp orders ----------------
 
+_COOLDOWN_PREFIX = (
+    "Заявку можно отправлять не чаще 1 раза в 5 минут.\n"
+    "Попробуйте через "
+)
+
+# Submissions are acked immediately and drained by submit_worker, which batches
+# inserts from a short window into one transaction and one dispatcher message.
+SUBMIT_BATCH_MAX = 10
+SUBMIT_BATCH_WINDOW = 0.2
+# The user was already told the request was sent, so a DB hiccup must not eat
+# the batch: retry with backoff, then insert per item, then report the rest.
+SUBMIT_INSERT_ATTEMPTS = 3
+SUBMIT_RETRY_DELAY = 0.5  # doubles per attempt
+# How long shutdown waits for queued/in-flight submissions to commit before
+# cancelling the worker and releasing the cooldowns of whatever is left.
+SUBMIT_SHUTDOWN_TIMEOUT = 10.0
+
+submit_queue: asyncio.Queue | None = None
+
+
 @dp.message(F.web_app_data)
 async def webapp_data_handler(message: Message) -> None:
     uid = message.from_user.id
-    now = time.time()
+    now = time.monotonic()
 
     last = last_request_ts.get(uid)
     if last is not None and (now - last) < COOLDOWN_SECONDS:
         remain = int(COOLDOWN_SECONDS - (now - last))
-        await message.answer(
-            "Заявку можно отправлять не чаще 1 раза в 5 минут.\n"
-            f"Попробуйте через {remain//60:02d}:{remain%60:02d}."
-        )
+        await message.answer(_COOLDOWN_PREFIX + f"{remain//60:02d}:{remain%60:02d}.")
+        return
+
+    # Local cache miss: user_state.last_request_at is the source of truth
+    # (other replicas, restarts). The claim is a single atomic upsert; the
+    # extra remaining-time query only runs on the rejected, cold path.
+    try:
+        claimed = await db_try_claim_cooldown(uid)
+    except Exception:
+        claimed = True
+    if not claimed:
+        try:
+            remain = await db_cooldown_remaining(uid)
+        except Exception:
+            remain = COOLDOWN_SECONDS
+        last_request_ts[uid] = now - (COOLDOWN_SECONDS - remain)
+        await message.answer(_COOLDOWN_PREFIX + f"{remain//60:02d}:{remain%60:02d}.")
         return
 
     raw = message.web_app_data.data
     try:
-        data = json.loads(raw)
+        data = orjson.loads(raw)
     except Exception:
         data = {"raw": raw}
 
-    sender = message.from_user
-    req_id = await db_create_request(u=sender, payload=data)
+    # Persistence and the dispatcher notify happen in submit_worker; the user
+    # only waits for their own ack.
+    last_request_ts[uid] = now
+    submit_queue.put_nowait((message.from_user, data))
 
+    await message.answer(
+        "Заявка отправлена, ожидайте, с вами свяжется диспетчер, обычно до 5 минут. "
+        "По истечению этого времени, наберите по номеру +7 (965) 747-07-27"
+    )
+
+
+def _build_request_notification(req_id: int, sender, data: dict, yandex_link: str | None) -> str:
     phone = _clean(data.get("phoneFormatted") or data.get("phone"))
     address = _clean(data.get("address"))
     car_brand = _clean(data.get("carBrand"))
     geo = _clean(data.get("geo"))
     ts = data.get("ts")
-    yandex_link = _yandex_maps_link_from_geo(data.get("geo"))
 
-    sender_line = (
-        f"{sender.full_name}"
-        + (f" (@{sender.username})" if sender.username else "")
+    sender_line = f"{sender.full_name} (@{sender.username})" if sender.username else sender.full_name
+
+    text = (
+        f"Заявка на эвакуатор (ID: {req_id})\n"
+        "\n"
+        f"Время: {_dt(ts)}\n"
+        f"Клиент: {sender_line}\n"
+        f"Телефон: {phone}\n"
+        f"Марка: {car_brand}\n"
+        f"Адрес: {address}\n"
+        f"Гео: {geo}\n"
+        "Статус: new"
     )
-
-    lines = [
-        f"Заявка на эвакуатор (ID: {req_id})",
-        "",
-        f"Время: {_dt(ts)}",
-        f"Клиент: {sender_line}",
-        f"Телефон: {phone}",
-        f"Марка: {car_brand}",
-        f"Адрес: {address}",
-        f"Гео: {geo}",
-        "Статус: new",
-    ]
     if yandex_link:
-        lines.append(f"Яндекс.Карты: {yandex_link}")
+        text += f"\nЯндекс.Карты: {yandex_link}"
+    return text
+
+
+def _build_batch_notification(items: list[tuple[int, Any, dict, str | None]]) -> str:
+    blocks = []
+    for req_id, sender, data, _link in items:
+        phone = _clean(data.get("phoneFormatted") or data.get("phone"))
+        address = _clean(data.get("address"))
+        user_tag = f"@{sender.username}" if sender.username else sender.full_name
+        blocks.append(
+            f"#{req_id} | {user_tag} | {phone}\n"
+            f"Адрес: {address}\n"
+            f"Подробно: /request {req_id}"
+        )
+    return f"Новые заявки ({len(items)}):\n\n" + "\n\n".join(blocks)
+
+
+def _build_lost_notification(failed: list[tuple[Any, dict]]) -> str:
+    blocks = []
+    for sender, data in failed:
+        phone = _clean(data.get("phoneFormatted") or data.get("phone"))
+        address = _clean(data.get("address"))
+        user_tag = f"@{sender.username}" if sender.username else sender.full_name
+        blocks.append(f"{user_tag} | {phone}\nАдрес: {address}")
+    return (
+        f"ВНИМАНИЕ: не удалось сохранить заявки ({len(failed)}) — БД недоступна.\n"
+        "Клиенты уже получили подтверждение, свяжитесь с ними вручную:\n\n"
+        + "\n\n".join(blocks)
+    )
 
-    await message.bot.send_message(TARGET_USER_ID, "\n".join(lines))
 
-    last_request_ts[uid] = now
-    await message.answer(
-        "Заявка отправлена, ожидайте, с вами свяжется диспетчер, обычно до 5 минут. "
-        "По истечению этого времени, наберите по номеру +7 (965) 747-07-27"
+async def _release_cooldown(uid: int) -> None:
+    """Give a lost submission its slot back so the user can resend at once."""
+    last_request_ts.pop(uid, None)
+    try:
+        await DB_POOL.execute(
+            "UPDATE user_state SET last_request_at = NULL WHERE tg_user_id=$1", uid
+        )
+    except Exception:
+        pass
+
+
+async def _insert_submission(con, sender, data: dict) -> tuple[int, Any, dict, str | None]:
+    yandex_link = _yandex_maps_link_from_geo(data.get("geo"))
+    row = await con.fetchrow(_INSERT_REQUEST_SQL, *_request_insert_args(sender, data, yandex_link))
+    return int(row["id"]), sender, data, yandex_link
+
+
+async def submit_worker(bot: Bot) -> None:
+    """Drain WebApp submissions: a burst shares one transaction for the inserts
+    and the dispatcher gets one aggregated message instead of N."""
+    while True:
+        batch = [await submit_queue.get()]
+        try:
+            while len(batch) < SUBMIT_BATCH_MAX:
+                batch.append(await asyncio.wait_for(submit_queue.get(), SUBMIT_BATCH_WINDOW))
+        except asyncio.TimeoutError:
+            pass
+
+        items: list[tuple[int, Any, dict, str | None]] = []
+        failed: list[tuple[Any, dict]] = []
+
+        try:
+            delay = SUBMIT_RETRY_DELAY
+            for attempt in range(SUBMIT_INSERT_ATTEMPTS):
+                try:
+                    async with DB_POOL.acquire() as con:
+                        async with con.transaction():
+                            inserted = [await _insert_submission(con, s, d) for s, d in batch]
+                    items = inserted
+                    break
+                except Exception:
+                    if attempt + 1 < SUBMIT_INSERT_ATTEMPTS:
+                        await asyncio.sleep(delay)
+                        delay *= 2
+            else:
+                # The shared transaction kept failing — try each submission on
+                # its own so one bad row (or a lingering outage) can't sink
+                # the rest.
+                for sender, data in batch:
+                    try:
+                        async with DB_POOL.acquire() as con:
+                            items.append(await _insert_submission(con, sender, data))
+                    except Exception:
+                        failed.append((sender, data))
+
+            for sender, _data in failed:
+                await _release_cooldown(sender.id)
+                try:
+                    await bot.send_message(
+                        sender.id,
+                        "К сожалению, не удалось сохранить вашу заявку. "
+                        "Пожалуйста, отправьте её ещё раз или позвоните по номеру +7 (965) 747-07-27.",
+                    )
+                except Exception:
+                    pass
+
+            try:
+                if failed:
+                    await bot.send_message(TARGET_USER_ID, _build_lost_notification(failed))
+                if len(items) == 1:
+                    await bot.send_message(TARGET_USER_ID, _build_request_notification(*items[0]))
+                elif items:
+                    await bot.send_message(TARGET_USER_ID, _build_batch_notification(items))
+            except Exception:
+                pass
+        except asyncio.CancelledError:
+            # Shutdown caught us mid-batch: free the local cooldown slots (no
+            # awaits here — the task is already being cancelled) so these
+            # users aren't locked out after a quick restart.
+            for sender, _data in batch:
+                last_request_ts.pop(sender.id, None)
+            raise
+        finally:
+            for _ in batch:
+                submit_queue.task_done()
+
+
+async def _shutdown_submit_worker(task: asyncio.Task) -> None:
+    """Flush before stopping: users already got their ack, so give queued and
+    in-flight submissions a bounded window to commit, then release the
+    cooldown of anything that still couldn't be saved."""
+    try:
+        await asyncio.wait_for(submit_queue.join(), SUBMIT_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    task.cancel()
+    try:
+        await task
+    except (asyncio.CancelledError, Exception):
+        pass
+    while not submit_queue.empty():
+        sender, _data = submit_queue.get_nowait()
+        await _release_cooldown(sender.id)
+
+
+async def run_webhook(bot: Bot) -> None:
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", int(os.getenv("PORT", "8080")))
+    await site.start()
+
+    await bot.set_webhook(
+        WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        drop_pending_updates=True,
     )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 
 async def main() -> None:
@@ -671,13 +1122,29 @@ async def main() -> None:
     await db_init()
     await http_init()
 
+    global submit_queue
+    submit_queue = asyncio.Queue()
+
     bot = Bot(token=BOT_TOKEN)
+    submit_task = asyncio.create_task(submit_worker(bot))
     try:
-        await dp.start_polling(bot)
+        if WEBHOOK_BASE_URL:
+            await run_webhook(bot)
+        else:
+            # A webhook left over from a previous deploy makes getUpdates
+            # return 409 Conflict; clear it before falling back to polling.
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     finally:
+        await _shutdown_submit_worker(submit_task)
         await http_close()
         await db_close()
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     asyncio.run(main())